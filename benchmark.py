@@ -0,0 +1,24 @@
+import timeit
+import s_expression
+
+## Many tiny messages, as received by a request-per-message server
+messages = [ '(msg %d (ok) "x")'%i for i in range(1000) ]
+
+def fresh():
+    for m in messages:
+        s_expression.Parser().loads(m)
+
+parser = s_expression.Parser()
+def reused():
+    for m in messages:
+        parser.loads(m)
+
+pool = s_expression.ParserPool(4)
+def pooled():
+    for m in messages:
+        pool.loads(m)
+
+if __name__ == '__main__':
+    for f in (fresh, reused, pooled):
+        t = min(timeit.repeat(f, number=1, repeat=5))
+        print('%-8s %.1f us/message'%(f.__name__, t / len(messages) * 1e6))
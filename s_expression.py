@@ -1,15 +1,14 @@
 #!/usr/bin/python3
 import sys
+import threading
+import contextlib
 import unicodedata
 
 def no_debug(*args):
     pass
 
-if __name__ == '__main__':
-    def debug(*args):
-        print(*args, file=sys.stderr)
-else:
-    debug = no_debug
+def print_debug(*args):
+    print(*args, file=sys.stderr)
 
 class Atom:
     def __init__(self, string, value, depth=0):
@@ -23,7 +22,10 @@ class Atom:
     def dump(self, initial_depth=None):
         if type(initial_depth) == type(None):
             initial_depth = self.depth
-        return Expression.depth_str(self.depth - initial_depth) + type(self).__name__ + ': ' + str(self) + '\n'
+        return self.dump_indent(self.depth - initial_depth)
+
+    def dump_indent(self, indent):
+        return Expression.depth_str(indent) + type(self).__name__ + ': ' + str(self) + '\n'
 
     def value(self):
         return self.__value
@@ -34,6 +36,17 @@ class Atom:
     def __str__(self):
         return self.string
 
+    def __eq__(self, other):
+        """ Structural equality: same atom type and same original string """
+        if self is other:
+            return True
+        if not isinstance(other, Atom):
+            return NotImplemented
+        return type(self) == type(other) and self.string == other.string
+
+    def __hash__(self):
+        return hash((type(self), self.string))
+
 class Token(Atom):
     pass
 
@@ -57,10 +70,21 @@ class Expression:
         self.parent = parent
         self.child = list()
         self.depth = depth
+        ## Structural hash, only cached once frozen
+        self._hash = None
 
     def cons(self, expression):
+        if type(self._hash) != type(None):
+            raise Exception('Cannot modify a frozen expression')
         self.child.append(expression)
 
+    def freeze(self):
+        """ Declare the expression immutable, so that its hash can be
+            cached. Children are expected to be frozen already """
+        if type(self._hash) == type(None):
+            self.child = tuple(self.child)
+            self._hash = hash(self.child)
+
     def depth_str(depth):
         s = ''
         for i in range(depth):
@@ -71,9 +95,14 @@ class Expression:
         """ Print a sub-tree below that point """
         if type(initial_depth) == type(None):
             initial_depth = self.depth
-        s = Expression.depth_str(self.depth - initial_depth) + type(self).__name__ + ':\n'
+        return self.dump_indent(self.depth - initial_depth)
+
+    def dump_indent(self, indent):
+        ## Indentation is passed down rather than taken from the children
+        ## depth, as shared sub-trees do not have a single depth
+        s = Expression.depth_str(indent) + type(self).__name__ + ':\n'
         for e in self.child:
-            s += e.dump(initial_depth)
+            s += e.dump_indent(indent + 1)
         return s
 
     def to_list(self):
@@ -92,6 +121,35 @@ class Expression:
         s += ')'
         return s
 
+    def __eq__(self, other):
+        """ Structural equality. Constant time for identical or shared
+            sub-trees, or for frozen sub-trees with different hashes.
+            Iterative, so that deep trees do not hit the recursion limit """
+        if not isinstance(other, Expression):
+            return NotImplemented
+        stack = [ (self, other) ]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            if not (isinstance(a, Expression) and isinstance(b, Expression)):
+                if a != b:
+                    return False
+                continue
+            if type(a._hash) != type(None) and type(b._hash) != type(None) \
+                    and a._hash != b._hash:
+                return False
+            if len(a.child) != len(b.child):
+                return False
+            stack.extend(zip(a.child, b.child))
+        return True
+
+    def __hash__(self):
+        """ Structural hash, cached on frozen expressions """
+        if type(self._hash) != type(None):
+            return self._hash
+        return hash(tuple(self.child))
+
 class State:
     """ The parser states """
     state_name = [ 'EXPRESSION', 'TOKEN', 'QUOTED_STRING', 'HEX_STRING', 'ESCAPE',
@@ -317,7 +375,18 @@ class Lexer:
             raise Exception('Program bug')
 
 class AST:
-    def __init__(self):
+    """ With dedup, structurally identical atoms and sub-expressions of a
+        document are built only once and shared. Shared nodes must not be
+        modified, and their parent and depth are those of their first
+        occurrence. """
+    def __init__(self, dedup=False):
+        self.dedup = dedup
+        ## Canonical nodes when deduplicating
+        if dedup:
+            self.node = dict()
+        self.reset()
+
+    def reset(self):
         ## Current expression
         self.expr = None
         ## Root node
@@ -325,6 +394,14 @@ class AST:
         ## Current depth: useless during parsing
         ## It is used in the __str__ methods. May have other uses.
         self.depth = 0
+        if self.dedup:
+            self.node.clear()
+
+    def intern(self, n):
+        """ Return the canonical node structurally equal to n """
+        if not self.dedup:
+            return n
+        return self.node.setdefault(n, n)
 
     def parse_error(self, msg):
         ## The exception is caught by the Parser
@@ -343,15 +420,20 @@ class AST:
         if self.depth == 0:
             self.parse_error('Too many closing parenthesis')
         self.depth -= 1
+        ## Expression is complete: its children are already frozen, so its
+        ## hash is computed in constant time. It can then be shared
+        self.expr.freeze()
+        e = self.intern(self.expr)
         if self.expr.parent:
-            self.expr.parent.cons(self.expr)
+            self.expr.parent.cons(e)
         else:
             ## Set root node at the end
             assert(self.depth == 0)
-            self.root = self.expr
+            self.root = e
         self.expr = self.expr.parent
 
     def add_atom(self, a):
+        a = self.intern(a)
         if self.expr:
             self.expr.cons(a)
         else:
@@ -390,42 +472,65 @@ class AST:
             self.parse_error('Missing closing parenthesis')
 
 class Parser:
-    def __init__(self):
+    """ A parser instance can be reused: loadf() and loads() start by
+        resetting it. An instance must not be used by several threads at the
+        same time, use one instance per thread or a ParserPool. """
+    def __init__(self, debug=False, dedup=False):
+        ## Reference to Character class (no pun intended)
+        self.cc = Character
+        ## Our lexer
+        self.lex = Lexer()
+        ## The Abstract Syntax Tree
+        self.ast = AST(dedup=dedup)
+        ## Debug output is per instance, so that it is not shared among threads
+        if debug:
+            self.debug = print_debug
+        else:
+            self.debug = no_debug
+        self.reset()
+
+    def reset(self):
+        """ Make the parser ready to parse a new input """
         ## Current parser state
         self.state = State.EXPRESSION
         ## Current line number
         self.lineno = 0
         ## Current column number
         self.colno = 0
-        ## Reference to Character class (no pun intended)
-        self.cc = Character
-        ## Our lexer
-        self.lex = Lexer()
-        ## The Abstract Syntax Tree
-        self.ast = AST()
-        assert(State.number() == len(Parser.transition))
+        self.lex.reset()
+        self.ast.reset()
 
     def loadf(self, filename):
-        f = open(filename, 'r', encoding='utf-8')
+        self.reset()
         try:
-            s = f.readline()
-            while s:
-                self.parseline(s)
+            f = open(filename, 'r', encoding='utf-8')
+            try:
                 s = f.readline()
-        except Exception as e:
+                while s:
+                    self.parseline(s)
+                    s = f.readline()
+            except Exception as e:
+                f.close()
+                raise e
             f.close()
-            raise e
-        f.close()
-        self.parseline((Character.EOF_char,))
-        assert(type(self.ast.root) != type(None))
-        return self.ast.root
+            self.parseline((Character.EOF_char,))
+            assert(type(self.ast.root) != type(None))
+            return self.ast.root
+        finally:
+            ## Do not keep the document alive while the parser is idle
+            self.ast.reset()
 
     def loads(self, s):
-        ## Assume only one line
-        self.parseline(s)
-        self.parseline((Character.EOF_char,))
-        assert(type(self.ast.root) != type(None))
-        return self.ast.root
+        self.reset()
+        try:
+            ## Assume only one line
+            self.parseline(s)
+            self.parseline((Character.EOF_char,))
+            assert(type(self.ast.root) != type(None))
+            return self.ast.root
+        finally:
+            ## Do not keep the document alive while the parser is idle
+            self.ast.reset()
 
     def print_char(self, c):
         """ Return a string representing c for human cunsumption, i.e.
@@ -522,6 +627,26 @@ class Parser:
         ['digit_hex', 'lex.cont_hex', True],
         ['expr', 'ast.end_hex', False, State.EXPRESSION],
     ]
+    ## Checked once, not for every instance
+    assert(State.number() == len(transition))
+
+    def make_action():
+        """ Resolve the action names of the transition table once, into
+            (unbound function, object name). Object name is empty for methods
+            of self """
+        cls = { 'lex': Lexer, 'ast': AST, '': Parser }
+        Parser.action = dict()
+        for trans in Parser.transition:
+            ## Some states have no transition (duplicate state name)
+            if type(trans) != type(list()):
+                continue
+            for t in trans:
+                act_method = t[1]
+                if type(act_method) != type(list()):
+                    act_method = (act_method,)
+                for a in act_method:
+                    o, _, m = a.rpartition('.')
+                    Parser.action[a] = (getattr(cls[o], m), o)
 
     def parseline(self, s):
         self.lineno += 1
@@ -543,13 +668,13 @@ class Parser:
                         act_method = (act_method,)
                     ## Call all actions
                     for a in act_method:
-                        debug(State.name(self.state), c, check_method, a)
-                        f = eval('self.' + a)
-                        if a.startswith('lex.'):
-                            f(c)
-                        elif a.startswith('ast.'):
+                        self.debug(State.name(self.state), c, check_method, a)
+                        f, o = Parser.action[a]
+                        if o == 'lex':
+                            f(self.lex, c)
+                        elif o == 'ast':
                             try:
-                                f(self.lex.string, self.lex.value)
+                                f(self.ast, self.lex.string, self.lex.value)
                             except Exception as e:
                                 self.parse_error(e)
                             self.lex.reset()
@@ -564,13 +689,76 @@ class Parser:
                 ## State transition
                 self.state = trans[3]
 
+Parser.make_action()
+
+class ParserPool:
+    """ A bounded pool of reusable parsers, safe to share among threads.
+        At most size parsers are created, lazily. When they are all in use,
+        acquire() blocks until one is released. Use parser() to acquire and
+        release in a with statement. """
+    def __init__(self, size, dedup=False):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+        self.size = size
+        self.dedup = dedup
+        ## Parsers not in use
+        self.free = list()
+        ## Number of parsers created so far
+        self.created = 0
+        ## id() of the parsers in use
+        self.used = set()
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while not self.free and self.created >= self.size:
+                self.cond.wait()
+            if self.free:
+                p = self.free.pop()
+                self.used.add(id(p))
+                return p
+            self.created += 1
+        try:
+            p = Parser(dedup=self.dedup)
+        except Exception as e:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise e
+        with self.cond:
+            self.used.add(id(p))
+        return p
+
+    def release(self, parser):
+        with self.cond:
+            if id(parser) not in self.used:
+                raise ValueError('Parser is not in use from this pool')
+            self.used.remove(id(parser))
+            self.free.append(parser)
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def parser(self):
+        p = self.acquire()
+        try:
+            yield p
+        finally:
+            self.release(p)
+
+    def loadf(self, filename):
+        with self.parser() as p:
+            return p.loadf(filename)
+
+    def loads(self, s):
+        with self.parser() as p:
+            return p.loads(s)
+
 if __name__ == '__main__':
-    r = Parser().loadf(sys.argv[1])
+    r = Parser(debug=True).loadf(sys.argv[1])
     assert(type(r) != type(None))
     print(r.dump())
     print(str(r))
     print(r.to_list())
-    debug = no_debug
     r2 = Parser().loads(str(r))
     assert(type(r2) != type(None))
     assert(str(r) == str(r2))
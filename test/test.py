@@ -1,5 +1,6 @@
 import os
 import stat
+import threading
 import unittest
 import s_expression
 
@@ -53,5 +54,117 @@ class TestSexpression(unittest.TestCase):
                 ## TODO: should check exception type
                 self.assertTrue(type(r) == type(None) and threw)
 
+    def test_parser_reuse(self):
+        p = s_expression.Parser()
+        self.assertEqual(str(p.loads('(a (b 0x10))')), '(a (b 0x10))')
+        self.assertEqual(str(p.loads('"c"')), '"c"')
+        ## Parser must be usable again after an error
+        with self.assertRaises(Exception):
+            p.loads('(a (b')
+        self.assertEqual(p.loads('(d 1)').to_list(), ['d', 1])
+        self.assertEqual(p.lineno, 2)
+
+    def test_parser_pool(self):
+        pool = s_expression.ParserPool(2)
+        errors = list()
+        def work(i):
+            try:
+                for j in range(20):
+                    s = '(t%d (n %d))'%(i, j)
+                    self.assertEqual(str(pool.loads(s)), s)
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=work, args=(i,)) for i in range(4) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(pool.created <= 2)
+        ## acquire() blocks while all parsers are checked out
+        p1 = pool.acquire()
+        p2 = pool.acquire()
+        acquired = threading.Event()
+        def acquire():
+            pool.acquire()
+            acquired.set()
+        t = threading.Thread(target=acquire)
+        t.start()
+        self.assertFalse(acquired.wait(0.1))
+        pool.release(p1)
+        self.assertTrue(acquired.wait(5))
+        t.join()
+        self.assertEqual(pool.created, 2)
+
+    def test_parser_pool_release(self):
+        pool = s_expression.ParserPool(1)
+        p = pool.acquire()
+        pool.release(p)
+        with self.assertRaises(ValueError):
+            pool.release(p)
+        with self.assertRaises(ValueError):
+            pool.release(s_expression.Parser())
+        with pool.parser() as p1:
+            self.assertEqual(str(p1.loads('(a)')), '(a)')
+        self.assertTrue(pool.acquire() is p1)
+
+    def test_dedup_sharing(self):
+        s = '(a (borrowed) (b (borrowed) 0x10) (b (borrowed) 0x10) "c")'
+        r = s_expression.Parser(dedup=True).loads(s)
+        self.assertEqual(str(r), s)
+        self.assertTrue(r.child[1] is r.child[2].child[1])
+        self.assertTrue(r.child[2] is r.child[3])
+        r2 = s_expression.Parser().loads(s)
+        self.assertFalse(r2.child[2] is r2.child[3])
+        self.assertEqual(r.dump(), r2.dump())
+
+    def test_dedup_release(self):
+        ## The parser does not keep the last document
+        p = s_expression.Parser(dedup=True)
+        p.loads('(a (b) (b))')
+        self.assertTrue(p.ast.root is None and not p.ast.node)
+
+    def test_structural_equality(self):
+        s = '(a (borrowed) (b (borrowed) 0x10) (b (borrowed) 0x10) "c")'
+        r = s_expression.Parser(dedup=True).loads(s)
+        r2 = s_expression.Parser().loads(s)
+        self.assertEqual(r, r2)
+        self.assertEqual(hash(r), hash(r2))
+        self.assertNotEqual(r, s_expression.Parser().loads('(a (b 16))'))
+        self.assertNotEqual(r, s_expression.Parser().loads('(a (b 0x10))'))
+        self.assertEqual(len(set(r2.child)), 4)
+        directory = os.path.join('test', 'success')
+        for filename in scandir(directory):
+            if is_file(filename):
+                r = s_expression.Parser(dedup=True).loadf(filename)
+                self.assertEqual(r, s_expression.Parser().loadf(filename))
+
+    def test_mutation(self):
+        ## Parsed expressions are frozen
+        q = s_expression.Parser().loads('(a (b))')
+        with self.assertRaises(Exception):
+            q.child[1].cons(s_expression.Token('c', 'c', 2))
+        with self.assertRaises(Exception):
+            q.child[1].child.append(s_expression.Token('c', 'c', 2))
+        self.assertEqual(str(q), '(a (b))')
+        ## Expressions built by hand are not, and still compare structurally
+        e = s_expression.Expression()
+        e.cons(s_expression.Token('a', 'a', 1))
+        b = s_expression.Expression(parent=e, depth=1)
+        e.cons(b)
+        self.assertNotEqual(e, s_expression.Parser().loads('(a (b c))'))
+        b.cons(s_expression.Token('b', 'b', 2))
+        b.cons(s_expression.Token('c', 'c', 2))
+        self.assertEqual(e, s_expression.Parser().loads('(a (b c))'))
+        self.assertEqual(hash(e), hash(s_expression.Parser().loads('(a (b c))')))
+
+    def test_deep(self):
+        s = '(' * 1500 + ')' * 1500
+        r = s_expression.Parser().loads(s)
+        r2 = s_expression.Parser(dedup=True).loads(s)
+        self.assertEqual(hash(r), hash(r2))
+        self.assertEqual(r, r2)
+        self.assertNotEqual(r, s_expression.Parser().loads('(' * 1499 + ')' * 1499))
+
 if __name__ == '__main__':
     unittest.main()